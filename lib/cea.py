@@ -10,8 +10,20 @@
 # peek the manual at http://akrmys.com/public/cea/doc/xRP-1311P2.pdf if you hate urself
 
 import subprocess
+import asyncio
 import os
 import pathlib
+import functools
+import itertools
+import multiprocessing
+import shutil
+import tempfile
+import hashlib
+import mmap
+import numbers
+import pickle
+import re
+import dataclasses
 import numpy as np
 from dataclasses import dataclass
 
@@ -19,133 +31,358 @@ CEA_PATH = pathlib.Path(__file__).parent / 'CEA'
 CEA_EXE = CEA_PATH / 'FCEA2m.exe'
 CEA_INP = CEA_PATH / 'ceadata.inp'
 CEA_OUT = CEA_PATH / 'ceadata.out'
+CEA_CACHE = CEA_PATH / 'cache'  # saved results from previous runs, see run_cea
+# part of every cache key. bump it whenever parsing or the CEAOutputData fields change,
+# so results saved in the old shape stop being used
+_CACHE_VERSION = 1
+CEA_LIBS = ('thermo.lib', 'trans.lib')  # data files FCEA2m.exe reads from its working directory
 
+# on windows, stops every CEA run from opening a console window (which costs time). has to be 0 elsewhere
+_CREATIONFLAGS = getattr(subprocess, 'CREATE_NO_WINDOW', 0)
 
-@dataclass
+# directory run_cea runs CEA in. propellant study workers each switch to their own copy (see _init_worker)
+_cea_dir = CEA_PATH
+
+
+@dataclass(frozen=True)
 class CEAInputData:
-    pcham = None
-    pamb = None
-    of = None
-    fuel_chems = None
-    fuel_chem_mass_percs = None
-    fuel_initial_temp = None
-    ox_chem = None
-    ox_initial_temp = None
-    equilibrium = None
-
-
-def create_inp_file(inp: CEAInputData):
+    '''inputs for one CEA rocket problem. frozen (immutable) so it's hashable, which is what lets
+    run_cea memoize on it. make a new one with dataclasses.replace(inp, pcham=...) to change a value'''
+    pcham: float  # [bar]
+    pamb: float  # [bar]
+    of: float  # [~]
+    fuel_chems: tuple  # CEA formula strings
+    fuel_chem_mass_percs: tuple  # [%]
+    fuel_initial_temp: float  # [K]
+    ox_chem: str
+    ox_initial_temp: float  # [K]
+    equilibrium: bool
+
+    def __post_init__(self):
+        # lists (e.g. straight from a .yaml) aren't hashable, so store them as tuples
+        object.__setattr__(self, 'fuel_chems', tuple(self.fuel_chems))
+        object.__setattr__(self, 'fuel_chem_mass_percs',
+                           tuple(self.fuel_chem_mass_percs))
+
+
+@functools.lru_cache(maxsize=None)
+def _inp_template(equilibrium, fuel_chems, fuel_chem_mass_percs, fuel_initial_temp, ox_chem, ox_initial_temp) -> str:
+    def literal(text):
+        return str(text).replace('{', '{{').replace('}', '}}')  # so names can't be mistaken for placeholders
+
+    eqbr_arg = 'equilibrium' if equilibrium else 'frozen nfz=1'
+    # equilibrium assumes rxns stay at equilibrium (inf. rxn rates) throughout nozzle flow
+    # allowing rxns to absorb energy from flow. slightly underestimates engine performance
+    # frozen nfz=1 assumes all equilbria fix at the nozzle throat. overestimates performance
+    lines = ['problem',
+             'rocket',
+             eqbr_arg,
+             # parameters for problem. filled in per point by _inp_text
+             "p,bar={pcham:.3f}",
+             "pip={pip:.3f}",
+             "o/f={of}",
+             # specify reactants (fuel/ox)
+             'react']
+    for fuel_chem, fuel_chem_mass_perc in zip(fuel_chems, fuel_chem_mass_percs):
+        lines.append(
+            f"fuel={literal(fuel_chem)} wt={fuel_chem_mass_perc:.3f} t,K={fuel_initial_temp:.3f}")
+    lines.append(f"ox={literal(ox_chem)} wt 100 t,K {ox_initial_temp:.3f}")
+    lines.append('end')  # last thing in the file. required!
+    return '\n'.join(lines)
+
+
+def make_inp_template(inp: CEAInputData) -> str:
+    '''returns the contents of a CEA .inp file for inp with {pcham}, {pip} (= pcham/pamb) and {of} left as
+    str.format placeholders. in a propellant study only those change between points, so everything else
+    (reactants, temperatures, equilibrium setting) is built once per study rather than once per point'''
+    return _inp_template(inp.equilibrium, inp.fuel_chems, inp.fuel_chem_mass_percs, inp.fuel_initial_temp,
+                         inp.ox_chem, inp.ox_initial_temp)
+
+
+def _inp_text(inp: CEAInputData) -> str:
+    '''returns the contents of a CEA .inp file for the design parameters in inp'''
+    return make_inp_template(inp).format(pcham=inp.pcham, pip=inp.pcham/inp.pamb, of=inp.of)
+
+
+def create_inp_file(inp: CEAInputData, cea_dir: pathlib.Path = CEA_PATH):
     '''creates a .inp file for CEA based on the design parameters in data.'''
-    with open(CEA_INP, mode='w') as f:
-        f.write('problem\n')
-        f.write('rocket\n')
-
-        eqbr_arg = 'equilibrium' if inp.equilibrium else 'frozen nfz=1'
-        # equilibrium assumes rxns stay at equilibrium (inf. rxn rates) throughout nozzle flow
-        # allowing rxns to absorb energy from flow. slightly underestimates engine performance
-        # frozen nfz=1 assumes all equilbria fix at the nozzle throat. overestimates performance
-        f.write(f'{eqbr_arg}\n')
-
-        # parameters for problem
-        f.write(f"p,bar={inp.pcham:.3f}\n")
-        f.write(
-            f"pip={inp.pcham/inp.pamb:.3f}\n")
-        f.write(f"o/f={inp.of}\n")
-
-        # specify reactants (fuel/ox)
-        f.write('react\n')
-        for fuel_chem, fuel_chem_mass_perc in zip(inp.fuel_chems, inp.fuel_chem_mass_percs):
-            f.write(
-                f"fuel={fuel_chem} wt={fuel_chem_mass_perc:.3f} t,K={inp.fuel_initial_temp:.3f}\n")
-        f.write(
-            f"ox={inp.ox_chem} wt 100 t,K {inp.ox_initial_temp:.3f}\n")
-
-        f.write('end')  # last thing in the file. required!
-
-
-def run_executable() -> str:
-    '''runs the FCEA2m.exe executable on ceadata.inp. returns the full path to the output file'''
+    # build the file in memory and write it in one go
+    (cea_dir / CEA_INP.name).write_text(_inp_text(inp))
+
+
+def run_executable(cea_dir: pathlib.Path = CEA_PATH) -> str:
+    '''runs the FCEA2m.exe executable on ceadata.inp in cea_dir. returns the full path to the output file'''
     # FCEA2m.exe is *special*
     # it takes no cmd line arguments, but when you run it it expects you to type something in
     # namely, the name of the input file, without the .inp ext.
 
     # this method will make the program crash if there are any issues running the command line
-    subprocess.run([CEA_EXE], input=f'ceadata\n', cwd=CEA_PATH,
-                   check=True, shell=True,  stdout=subprocess.DEVNULL,
-                   encoding='ascii')
+    # no shell=True: that would start cmd.exe first and have it start CEA, doubling the launch cost
+    subprocess.run([str(CEA_EXE)], input='ceadata\n', cwd=cea_dir,
+                   check=True, stdout=subprocess.DEVNULL,
+                   encoding='ascii', creationflags=_CREATIONFLAGS)
 
 
-@dataclass
+@dataclass(frozen=True)  # frozen since run_cea hands the same object to every caller
 class CEAOutputData:
     chamber_temp: float = 0
-    exhaust_gamma: float = 0
-    exhaust_molar_mass: float = 0
+    throat_gamma: float = 0
+    throat_molar_mass: float = 0
     cstar: float = 0
     exhaust_velocity: float = 0
 
 
-def parse_out_file() -> CEAOutputData:
-    '''parses the ceadata.out file. returns a dictionary of design parameters that resulted from running CEA'''
-    r = CEAOutputData()
-    with open(CEA_OUT, 'r') as f:
-        relevant_flag = False  # True when we're in the section of the outfile with numbers
-        for line in f.readlines():
-            if relevant_flag:
-                if 'T, K' in line:
-                    r.chamber_temp = float(
-                        line.split()[2])  # [K]
-                elif 'GAMMAs' in line:
-                    r.throat_gamma = float(
-                        line.split()[2])  # throat
-                    # line.split()[3])  # [~] #index 3: exit
-                elif 'M, (1/n)' in line:
-                    r.throat_molar_mass = float(
-                        line.split()[3])  # throat
-                    # line.split()[4])  # [kg/kmol] #index 4: exit
-                elif 'CSTAR, M/SEC' in line:
-                    r.cstar = float(
-                        line.split()[3])  # [m/s]
-                elif 'Isp, M/SEC' in line:
-                    r.exhaust_velocity = float(
-                        line.split()[3])  # [m/s]
-
-            if 'THEORETICAL ROCKET PERFORMANCE' in line:
-                relevant_flag = True  # start of results section of .out file
-            elif 'PRODUCTS WHICH WERE CONSIDERED' in line:
-                relevant_flag = False  # end of results section
-    return r
-
-
-# def run_propellant_study(data: dict, chamber_pressures: [float], of_ratios: [float]) \
-#         -> [[(float, float)]]:
-#     '''runs CEA to calculate performance and chamber temperature over the supplied of_ratios and
-#     chamber_presures. use_cea_isp False will calculate the ideal IsReturns a 2D array of(isp, chamber_temp) with pressures as rows and ratios as cols'''
-#     data = data.copy()  # so we don't overwrite the design parameters
-#     print('Starting CEA calculations')
-#     table = []
-#     n, N = 0, len(chamber_pressures) * len(of_ratios)  # progress bar
-#     for pcham in chamber_pressures:
-#         row = []
-#         for of_ratio in of_ratios:
-#             data['engine']['chamber_pressure'] = pcham
-#             data['propellants']['of_ratio'] = of_ratio
-
-#             create_inp_file(data)
-#             run_executable()
-#             parse_out_file(data)
-#             # cea isp max: 2.25
-#             # cea cstar max: 2.05
-#             # calculated cstar max: 2.15
-#             isp = data['engine']['cea_exhaust_velocity']  # nozzle.c_star(
-#             # output['exhaust_gamma'], output['exhaust_molar_mass'], output['chamber_temp'])
-#             chamber_temp = data['engine']['chamber_temp']
-
-#             row.append((isp, chamber_temp))
-#             n += 1
-#         table.append(row)
-#         print(f'{n} of {N} CEA calculations done.')
-#     print('CEA calculations done')
-#     return table
+# lines of the .out results section we read. group 1 is the label, group 2 the numbers after it
+# (bytes, since the .out file is searched in place with mmap. \r? for windows line endings)
+_CEA_RE = re.compile(
+    rb'^\s*(T, K|GAMMAs|M, \(1/n\)|CSTAR, M/SEC|Isp, M/SEC)\s+([\d\.\-Ee+ ]+)\r?$', re.M)
+# one number on one of those lines
+_FLOAT_RE = re.compile(rb'[-+]?\d+\.\d+(?:[Ee][-+]?\d+)?')
+# label -> (CEAOutputData attribute, which number on the line to take)
+_CEA_FIELDS = {
+    b'T, K': ('chamber_temp', 0),  # [K] chamber
+    b'GAMMAs': ('throat_gamma', 1),  # [~] throat (2: exit)
+    b'M, (1/n)': ('throat_molar_mass', 1),  # [kg/kmol] throat (2: exit)
+    b'CSTAR, M/SEC': ('cstar', 1),  # [m/s]
+    b'Isp, M/SEC': ('exhaust_velocity', 1),  # [m/s]
+}
+
+
+def _read_results(out_file: pathlib.Path, max_sections: int = None) -> [bytes]:
+    '''returns the results section of each problem in a .out file (up to max_sections of them), in order.
+    the numbers we want are all between these two headings. the file is mmapped and searched in place,
+    so only the results sections get copied into memory, and the search stops at the last one we need'''
+    sections = []
+    with open(out_file, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return sections  # CEA wrote nothing (and an empty file can't be mmapped)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            start = mm.find(b'THEORETICAL ROCKET PERFORMANCE')
+            while start != -1 and len(sections) != max_sections:
+                end = mm.find(b'PRODUCTS WHICH WERE CONSIDERED', start)
+                if end == -1:
+                    raise ValueError(f'{out_file} ends partway through a results section')
+                sections.append(mm[start:end])
+                start = mm.find(b'THEORETICAL ROCKET PERFORMANCE', end)
+    return sections
+
+
+def _parse_results(section: bytes) -> CEAOutputData:
+    '''picks the numbers we use out of one results section of a .out file'''
+    values = {}
+    for m in _CEA_RE.finditer(section):
+        attr, i = _CEA_FIELDS[m.group(1)]
+        # scan the numbers in place and only convert the one we want, instead of splitting the line up
+        number = next(itertools.islice(_FLOAT_RE.finditer(section, m.start(2), m.end(2)), i, None), None)
+        if number is None:
+            raise ValueError(f'CEA results line {m.group().strip().decode()!r} is missing a column')
+        values[attr] = float(number.group())
+    if len(values) < len(_CEA_FIELDS):
+        missing = [label.decode() for label, (attr, i) in _CEA_FIELDS.items() if attr not in values]
+        raise ValueError(f'CEA results are missing {missing}')
+    return CEAOutputData(**values)
+
+
+def parse_out_file(cea_dir: pathlib.Path = CEA_PATH) -> CEAOutputData:
+    '''parses the ceadata.out file in cea_dir. returns a dictionary of design parameters that resulted from running CEA'''
+    # only the first problem's results. run_cea_batch handles files with several problems in them
+    sections = _read_results(cea_dir / CEA_OUT.name, max_sections=1)
+    if not sections:
+        raise ValueError(f'no results in {cea_dir / CEA_OUT.name}')
+    return _parse_results(sections[0])
+
+
+def _canonical(value):
+    '''converts numbers to plain floats (recursing into tuples) so e.g. 30, 30.0 and np.float64(30)
+    give the same cache key'''
+    if isinstance(value, tuple):
+        return tuple(_canonical(v) for v in value)
+    if isinstance(value, numbers.Real) and not isinstance(value, bool):
+        return float(value)
+    return value
+
+
+def _cache_file(inp: CEAInputData) -> pathlib.Path:
+    '''returns the path the result for inp is saved to. named by a hash of the input values and
+    _CACHE_VERSION, which (unlike python's hash()) stays the same between sessions'''
+    key = repr((_CACHE_VERSION, _canonical(dataclasses.astuple(inp)))).encode()
+    return CEA_CACHE / f'{hashlib.blake2b(key, digest_size=16).hexdigest()}.pkl'
+
+
+@functools.lru_cache(maxsize=4096)
+def run_cea(inp: CEAInputData) -> CEAOutputData:
+    '''runs CEA for inp and returns the parsed results (create_inp_file, run_executable, parse_out_file).
+    results are memoized on inp, and also saved to CEA_CACHE so later sessions don't relaunch the exe
+    for a design that's already been run. the returned CEAOutputData is shared between calls, which is why it's frozen.
+    call clear_cache() if you change the propellant definitions CEA uses (thermo.inp)'''
+    cache_file = _cache_file(inp)
+    if cache_file.exists():
+        return _load_cached(cache_file)
+
+    create_inp_file(inp, _cea_dir)
+    run_executable(_cea_dir)
+    out = parse_out_file(_cea_dir)
+
+    _save_cached(cache_file, out)
+    return out
+
+
+def _load_cached(cache_file: pathlib.Path) -> CEAOutputData:
+    with open(cache_file, 'rb') as f:
+        return pickle.load(f)
+
+
+def _save_cached(cache_file: pathlib.Path, out: CEAOutputData):
+    CEA_CACHE.mkdir(exist_ok=True)
+    tmp_file = cache_file.with_name(f'{cache_file.stem}_{os.getpid()}.tmp')
+    with open(tmp_file, 'wb') as f:
+        pickle.dump(out, f)
+    os.replace(tmp_file, cache_file)  # so an interrupted run can't leave half a cache file behind
+
+
+def _split_cached(inps: [CEAInputData]) -> ({CEAInputData: CEAOutputData}, [CEAInputData]):
+    '''loads whatever results for inps are already in the on-disk cache.
+    returns those results and a list of the inputs that still need running, without repeats'''
+    results = {}
+    todo = []
+    for inp in dict.fromkeys(inps):  # don't run repeated points twice
+        cache_file = _cache_file(inp)
+        if cache_file.exists():
+            results[inp] = _load_cached(cache_file)
+        else:
+            todo.append(inp)
+    return results, todo
+
+
+def run_cea_batch(inps: [CEAInputData]) -> [CEAOutputData]:
+    '''runs CEA for each of inps with a single launch of the exe, returning the results in the same order.
+    FCEA2m.exe only takes one input file name per launch (then exits), but it works through every problem
+    in that file, so putting all the problems in one file pays the exe's startup cost once instead of per point.
+    like run_cea, uses and fills the on-disk cache'''
+    results, todo = _split_cached(inps)
+    if todo:
+        (_cea_dir / CEA_INP.name).write_text('\n'.join(_inp_text(inp) for inp in todo))
+        run_executable(_cea_dir)
+        # stop at the last section we asked for, rather than searching the species lists etc. after it
+        sections = _read_results(_cea_dir / CEA_OUT.name, max_sections=len(todo))
+        if len(sections) != len(todo):
+            # a problem that failed has no results, so we can't tell which section goes with which input
+            raise ValueError(f'CEA gave results for {len(sections)} of {len(todo)} problems. '
+                             f'see {_cea_dir / CEA_OUT.name}')
+        for inp, section in zip(todo, sections):
+            results[inp] = _parse_results(section)
+            _save_cached(_cache_file(inp), results[inp])
+    return [results[inp] for inp in inps]
+
+
+def clear_cache():
+    '''forgets all saved CEA results, in memory and on disk'''
+    run_cea.cache_clear()
+    for cache_file in CEA_CACHE.glob('*.pkl'):
+        cache_file.unlink()
+
+
+def _make_cea_dir(cea_dir: pathlib.Path) -> pathlib.Path:
+    '''sets up a separate directory to run CEA in. needed to run several copies of CEA at once,
+    since FCEA2m.exe always reads and writes ceadata.inp/.out in its working directory'''
+    cea_dir.mkdir()
+    for lib in CEA_LIBS:
+        shutil.copy(CEA_PATH / lib, cea_dir)
+    return cea_dir
+
+
+def _init_worker(scratch_dir: str):
+    '''gives a propellant study worker process its own directory to run CEA in'''
+    global _cea_dir
+    _cea_dir = _make_cea_dir(pathlib.Path(scratch_dir) / f'worker_{os.getpid()}')
+
+
+def run_propellant_study(base_inp: CEAInputData, pchams: [float], ofs: [float], processes: int = None) \
+        -> [[CEAOutputData]]:
+    '''runs CEA over every combination of chamber pressure and o/f ratio, taking the other inputs from base_inp.
+    returns a 2D list of results with pressures as rows and ratios as cols.
+    points already in the on-disk cache are loaded here; the rest are split into one batch (see run_cea_batch)
+    per process, default one process per cpu core'''
+    if processes is None:
+        processes = os.cpu_count() or 1  # cpu_count() is None when it can't be determined
+    elif processes < 1:
+        raise ValueError(f'processes must be at least 1, not {processes}')
+    inps = [dataclasses.replace(base_inp, pcham=pcham, of=of)
+            for pcham, of in itertools.product(pchams, ofs)]
+    results, todo = _split_cached(inps)
+    if todo:  # don't start any workers if everything was cached
+        n = -(-len(todo) // processes)  # points per batch, rounded up
+        batches = [todo[i:i + n] for i in range(0, len(todo), n)]
+        with tempfile.TemporaryDirectory(prefix='cea_study_') as scratch_dir, \
+                multiprocessing.Pool(len(batches), _init_worker, (scratch_dir,)) as pool:
+            for batch, outs in zip(batches, pool.map(run_cea_batch, batches)):
+                results.update(zip(batch, outs))
+    return [[results[dataclasses.replace(base_inp, pcham=pcham, of=of)] for of in ofs] for pcham in pchams]
+
+
+async def _run_cea_in_dir(inp: CEAInputData, cea_dirs: asyncio.Queue) -> CEAOutputData:
+    '''runs CEA for inp in whichever directory from cea_dirs is free (waiting for one if they're all busy)'''
+    cache_file = _cache_file(inp)
+    if cache_file.exists():
+        return _load_cached(cache_file)
+
+    cea_dir = await cea_dirs.get()
+    try:
+        create_inp_file(inp, cea_dir)
+        proc = await asyncio.create_subprocess_exec(str(CEA_EXE), cwd=cea_dir,
+                                                    stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                                                    creationflags=_CREATIONFLAGS)
+        try:
+            await proc.communicate(b'ceadata\n')
+        except asyncio.CancelledError:
+            # don't leave the exe running in a directory that's about to be deleted
+            if proc.returncode is None:
+                proc.kill()
+            await proc.wait()
+            raise
+        if proc.returncode:
+            raise subprocess.CalledProcessError(proc.returncode, str(CEA_EXE))
+        parse = asyncio.get_running_loop().run_in_executor(None, parse_out_file, cea_dir)
+        try:
+            out = await asyncio.shield(parse)
+        except asyncio.CancelledError:
+            await asyncio.wait([parse])  # the thread can't be stopped, so let it finish with the .out file
+            raise
+    finally:
+        cea_dirs.put_nowait(cea_dir)
+
+    _save_cached(cache_file, out)
+    return out
+
+
+async def run_cea_async(inps: [CEAInputData], max_procs: int = None) -> [CEAOutputData]:
+    '''runs CEA for each of inps, with up to max_procs (default one per cpu core) copies of the exe running at once.
+    returns the results in the same order. an alternative to run_propellant_study for arbitrary lists of inputs:
+    only the exe runs in parallel, so there are no extra python processes to start.
+    scripts only: run it with asyncio.run(cea.run_cea_async(...)). on windows jupyter runs a selector event loop,
+    which can't start subprocesses, so in a notebook use run_propellant_study or run_cea_batch instead'''
+    if max_procs is None:
+        max_procs = os.cpu_count() or 1
+    elif max_procs < 1:
+        raise ValueError(f'max_procs must be at least 1, not {max_procs}')
+    unique_inps = list(dict.fromkeys(inps))  # don't run repeated points twice
+    with tempfile.TemporaryDirectory(prefix='cea_async_') as scratch_dir:
+        # each running exe gets its own directory. the queue doubles as the limit on how many run at once
+        cea_dirs = asyncio.Queue()
+        for i in range(min(max_procs, len(unique_inps))):
+            cea_dirs.put_nowait(_make_cea_dir(pathlib.Path(scratch_dir) / f'proc_{i}'))
+        tasks = [asyncio.ensure_future(_run_cea_in_dir(inp, cea_dirs)) for inp in unique_inps]
+        try:
+            outs = await asyncio.gather(*tasks)
+        except BaseException:
+            # a run failed (or we were cancelled). gather doesn't stop the other runs, so cancel them and
+            # wait for their exes to exit before the with block deletes the directories they're running in
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+    results = dict(zip(unique_inps, outs))
+    return [results[inp] for inp in inps]
 
 
 # def plot_propellant_study(table: [[(float, float)]], pchams, ofs, show=False) -> str:
@@ -1,22 +1,49 @@
-import math
+import functools
+from math import pi, log10, sqrt  # bare names skip an attribute lookup on every use in the pipe flow math
+import numpy as np
 import CoolProp.CoolProp as cp
+from dataclasses import dataclass
+try:
+    from numba import njit
+except ImportError:  # numba is optional. without it the pipe flow functions just run as plain python
+    def njit(f):
+        return f
 
+AIR_MOLAR_MASS = cp.PropsSI('M', 'air')  # [kg/mol]
 
+
+@functools.lru_cache(maxsize=None)
+def _props(prop, T, P, fluid):
+    '''cp.PropsSI lookup of prop for fluid at temperature T [K] and pressure P [Pa].
+    cached, since CoolProp lookups are slow and loops over design parameters repeat the same states'''
+    return cp.PropsSI(prop, 'T', T, 'P', P, fluid)
+
+
+@functools.lru_cache(maxsize=None)
+def _props_pure(prop, fluid):
+    '''cached cp.PropsSI lookup of a property that doesn't depend on state (e.g. 'M', molar mass)'''
+    return cp.PropsSI(prop, fluid)
+
+
+@njit
 def reynolds_number(mdot, diameter, viscosity):
     '''returns Reynolds number [~] for fluid flowing in circular pipe given:
-    mdot [kg/s], diameter [m], viscosity (dynamic) [kg/m/s]'''
-    area = math.pi * diameter**2 / 4
-    return mdot * diameter / viscosity / area
+    mdot [kg/s], diameter [m], viscosity (dynamic) [kg/m/s]
+    Re = rho*v*d/visc, and rho*v = mdot/area = 4*mdot/(pi*d^2), so Re = 4*mdot/(pi*d*visc).
+    written that way on purpose: computing the area and dividing by it again is extra work for the same number'''
+    return 4.0 * mdot / (pi * diameter * viscosity)
 
 
+@njit
 def darcy_friction_factor(mdot, roughness, diameter, reynolds):
     '''returns Darcy friction factor [~] for fluid flowing in circular pipe given:
     mdot [kg/s], diameter [m], roughness [m], Reynolds number [~]
     uses Haaland approx. of Colebrook eqn. https://en.wikipedia.org/wiki/Darcy_friction_factor_formulae'''
-    f = 1 / (-1.8*math.log10((roughness/diameter/3.7)**1.11 + 6.9/reynolds))**2
+    f = 1 / (-1.8*log10((roughness/diameter/3.7)**1.11 + 6.9/reynolds))**2
     return f
 
 
+@njit
 def pressure_drop(length, mdot, diameter, roughness, rho, viscosity):
     '''returns pressure drop [bar] as fluid flows through circular tubing, given:
     length [m] of tubing
@@ -29,27 +56,30 @@ def pressure_drop(length, mdot, diameter, roughness, rho, viscosity):
     https://en.wikipedia.org/wiki/Darcy%E2%80%93Weisbach_equation'''
     reynolds = reynolds_number(mdot, diameter, viscosity)
     friction = darcy_friction_factor(mdot, roughness, diameter, reynolds)
-    dP = length * friction * 8 / (math.pi ** 2) * \
-        (mdot ** 2) / rho / (diameter ** 5)
+    d2 = diameter * diameter
+    dP = length * friction * 8 / (pi ** 2) * \
+        (mdot * mdot) / rho / (d2 * d2 * diameter)
     return dP / 1e5  # to bar
 
 
+@njit
 def velocity(mdot, diameter, rho):
     '''returns velocity of flow in circular pipe [m/s] given:
     mdot [kg/s]
     diameter [m]
     rho [kg/m3]'''
     Vdot = mdot / rho
-    area = math.pi * diameter ** 2 / 4
+    area = pi * diameter ** 2 / 4
     vel = Vdot / area
     return vel
 
 
+@njit
 def valve_flow_coefficient(Vdot, P_in, P_out, T, molar_mass):
     '''returns min. Cv for a valve
     based on http://www.idealvalve.com/pdf/Flow-Calculation-for-Gases.pdf'''
     # the "specific gravity" they ask for is really just the ratio of molar masses
-    specific_gravity = molar_mass / cp.PropsSI('M', 'air')
+    specific_gravity = molar_mass / AIR_MOLAR_MASS
     Vdot_cfh = Vdot * 127133
     T_Rankine = T * 1.8
     P_out_psi = P_out * 14.504
@@ -57,35 +87,93 @@ def valve_flow_coefficient(Vdot, P_in, P_out, T, molar_mass):
     Vdot_standard_cfh = Vdot_cfh * P_out / 1.013 * 295 / T
     # this is the formula for choked valve flow in the pdf linked
     Cv = Vdot_standard_cfh * \
-        math.sqrt(specific_gravity * T) / (816 * P_out_psi)
+        sqrt(specific_gravity * T) / (816 * P_out_psi)
     return Cv
 
 
-def calculate(data: dict):
-    # find pressure drop in fuel lines
-    fuel_rho = data['propellants']['fuel_density']
-    fuel_visc = data['propellants']['fuel_viscosity']
-    roughness = data['plumbing']['roughness']
-
-    dp_fuel = pressure_drop(data['plumbing']['fuel_length'], data['engine']['fuel_mass_flow'],
-                            data['plumbing']['fuel_diam']*2.54e-2, roughness, fuel_rho, fuel_visc)
-    data['plumbing']['fuel_pressure_drop'] = dp_fuel
-    data['plumbing']['fuel_flow_vel'] = velocity(
-        data['engine']['fuel_mass_flow'], data['plumbing']['fuel_diam']*2.54e-2, fuel_rho)
-
-    # pressure drop in ox lines
-    ox_temp = data['propellants']['ox_initial_temp']
-    ox_press = (data['engine']['chamber_pressure'] +
-                data['injector']['ox_pressure_drop'])*1e5  # bar to Pa
-    fl = data['propellants']['ox_chem']
-    ox_rho = cp.PropsSI('D', 'T', ox_temp, 'P', ox_press, fl)
-    ox_visc = cp.PropsSI('V', 'T', ox_temp, 'P', ox_press, fl)
-    data['plumbing']['ox_pressure_drop'] = pressure_drop(data['plumbing']['ox_length'], data['engine']['ox_mass_flow'],
-                                                         data['plumbing']['ox_diam'] * 2.54e-2, roughness, ox_rho, ox_visc)
-    data['plumbing']['ox_flow_vel'] = velocity(
-        data['engine']['ox_mass_flow'], data['plumbing']['ox_diam'] * 2.54e-2, ox_rho)
+@njit
+def plumbing_all(fuel_length, fuel_mdot, fuel_diam, fuel_rho, fuel_visc,
+                 ox_length, ox_mdot, ox_diam, ox_rho, ox_visc, roughness):
+    '''returns (fuel pressure drop [bar], fuel flow velocity [m/s], ox pressure drop [bar], ox flow velocity [m/s])
+    for the fuel and ox lines. does all the pipe flow math for calculate() in one compiled call'''
+    return (pressure_drop(fuel_length, fuel_mdot, fuel_diam, roughness, fuel_rho, fuel_visc),
+            velocity(fuel_mdot, fuel_diam, fuel_rho),
+            pressure_drop(ox_length, ox_mdot, ox_diam, roughness, ox_rho, ox_visc),
+            velocity(ox_mdot, ox_diam, ox_rho))
+
+
+def pressure_drop_vec(length, mdot, diameter, roughness, rho, viscosity):
+    '''array version of pressure_drop, for sweeps over plumbing or engine parameters.
+    takes numpy arrays (or scalars) that broadcast together, returns pressure drop [bar] at each point.
+    the Reynolds number is folded into the friction factor expression (6.9/Re = 6.9*pi*d*visc/(4*mdot))'''
+    friction = 1 / (-1.8*np.log10((roughness/diameter/3.7)**1.11 +
+                                  6.9*np.pi*diameter*viscosity/(4*mdot)))**2
+    return length * friction * 8 / np.pi**2 * mdot**2 / rho / diameter**5 / 1e5
+
+
+@dataclass
+class Plumbing:
+    fuel_diam: float  # [inch]
+    fuel_length: float  # [m] length of pipe run
+    ox_diam: float  # [inch]
+    ox_length: float  # [m]
+    tank_press: float  # [bar]
+    roughness: float  # [m]
+
+
+@dataclass
+class Engine:
+    chamber_pressure: float  # [bar]
+    fuel_mass_flow: float  # [kg/s]
+    ox_mass_flow: float  # [kg/s]
+
+
+@dataclass
+class Propellants:
+    fuel_density: float  # [kg/m3]
+    fuel_viscosity: float  # [Pa-s]
+    ox_chem: str  # CoolProp fluid name
+    ox_initial_temp: float  # [K]
+
+
+@dataclass
+class Injector:
+    ox_pressure_drop: float  # [bar]
+    fuel_volume_flow: float  # [m3/s]
+
+
+@dataclass
+class PlumbingOutputData:
+    fuel_pressure_drop: float = 0  # [bar]
+    fuel_flow_vel: float = 0  # [m/s]
+    ox_pressure_drop: float = 0  # [bar]
+    ox_flow_vel: float = 0  # [m/s]
+    ox_flow_coeff: float = 0  # [~] Cv
+
+
+def calculate(plumbing: Plumbing, engine: Engine, propellants: Propellants, injector: Injector) \
+        -> PlumbingOutputData:
+    r = PlumbingOutputData()
+    # fluid properties. fuel's are given, ox's come from CoolProp at injector inlet conditions
+    fuel_rho = propellants.fuel_density
+    fuel_visc = propellants.fuel_viscosity
+    ox_temp = propellants.ox_initial_temp
+    ox_press = (engine.chamber_pressure +
+                injector.ox_pressure_drop)*1e5  # bar to Pa
+    fl = propellants.ox_chem
+    ox_rho = _props('D', ox_temp, ox_press, fl)
+    ox_visc = _props('V', ox_temp, ox_press, fl)
+
+    # pressure drop and flow velocity in fuel and ox lines
+    fuel_diam = plumbing.fuel_diam * 2.54e-2  # inch to m
+    ox_diam = plumbing.ox_diam * 2.54e-2
+    r.fuel_pressure_drop, r.fuel_flow_vel, r.ox_pressure_drop, r.ox_flow_vel = plumbing_all(
+        plumbing.fuel_length, engine.fuel_mass_flow, fuel_diam, fuel_rho, fuel_visc,
+        plumbing.ox_length, engine.ox_mass_flow, ox_diam, ox_rho, ox_visc,
+        plumbing.roughness)
 
     # ox valve flow coefficient
-    ox_molar_mass = cp.PropsSI('M', data['propellants']['ox_chem'])
-    data['plumbing']['ox_flow_coeff'] = valve_flow_coefficient(
-        data['injector']['fuel_volume_flow'], data['plumbing']['tank_press'], data['injector']['ox_pressure_drop'] + data['engine']['chamber_pressure'], data['propellants']['ox_initial_temp'], ox_molar_mass)
+    ox_molar_mass = _props_pure('M', propellants.ox_chem)
+    r.ox_flow_coeff = valve_flow_coefficient(
+        injector.fuel_volume_flow, plumbing.tank_press, injector.ox_pressure_drop + engine.chamber_pressure, propellants.ox_initial_temp, ox_molar_mass)
+    return r